@@ -3,11 +3,18 @@
 import streamlit as st
 import os
 from dotenv import load_dotenv
-from query_pipeline import handle_user_query  # <- comes from your Colab backend
+from query_pipeline import stream_answer  # <- comes from your Colab backend
+import retriever
 
 # Load environment variables (Gemini + Neon)
 load_dotenv()
 
+# --- Model setup ---
+@st.cache_resource
+def get_embedder():
+    """Loads the BGE embedder once per worker (survives Streamlit reruns)."""
+    return retriever.get_embedder()
+
 # --- Page setup ---
 st.set_page_config(page_title="Club Knowledge Search Agent", page_icon="💡")
 st.title("💡 Club Knowledge Search Agent")
@@ -21,16 +28,20 @@ if "messages" not in st.session_state:
 for msg in st.session_state["messages"]:
     st.chat_message(msg["role"]).markdown(msg["content"])
 
+# Pre-warm the embedder so the first chat turn doesn't pay the model load
+get_embedder()
+
 # --- User input ---
 if prompt := st.chat_input("Ask your question here..."):
     st.session_state["messages"].append({"role": "user", "content": prompt})
     st.chat_message("user").markdown(prompt)
 
-    with st.spinner("Thinking..."):
+    # Stream tokens as they arrive instead of blocking on the full answer
+    with st.chat_message("assistant"):
         try:
-            response = handle_user_query(prompt)
+            response = st.write_stream(stream_answer(prompt))
         except Exception as e:
             response = f"⚠️ Error: {e}"
+            st.markdown(response)
 
-    st.session_state["messages"].append({"role": "assistant", "content": response})
-    st.chat_message("assistant").markdown(response)
+    st.session_state["messages"].append({"role": "assistant", "content": str(response)})
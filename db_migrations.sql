@@ -0,0 +1,61 @@
+-- Incremental schema changes for the Neon (PostgreSQL) database.
+-- Apply with: psql "$NEON_DB_URL" -f db_migrations.sql
+-- Statements use IF NOT EXISTS where Postgres allows it, so re-running is safe.
+
+-- Half-precision embeddings (requires pgvector >= 0.7).
+-- halfvec halves on-disk vector bytes and index memory; recall loss for BGE
+-- is negligible. The KNN scan is memory-bandwidth bound, so this directly
+-- speeds up retrieval. The FP32 `embedding` column can be dropped once
+-- `embedding_h` is verified in production.
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS embedding_h halfvec(768);
+UPDATE chunks SET embedding_h = embedding::halfvec(768) WHERE embedding_h IS NULL;
+CREATE INDEX IF NOT EXISTS chunks_embedding_h_hnsw
+    ON chunks USING hnsw (embedding_h halfvec_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+
+-- Full-text index for the keyword branch of the hybrid search.
+-- Without it every keyword query recomputes to_tsvector('english', ...) for
+-- every row of chunks; the functional GIN index uses the exact expression
+-- the query references, turning the scan into an index lookup.
+CREATE INDEX IF NOT EXISTS chunks_fts
+    ON chunks USING gin (to_tsvector('english', text_chunk));
+
+-- Materialized tsvector (supersedes chunks_fts above).
+-- Even with the functional GIN index, ts_rank_cd re-parses the chunk text
+-- for every candidate row on every query. A STORED generated column computes
+-- the tsvector once per insert/update instead, cutting per-query CPU on Neon;
+-- the query reads `tsv` directly for both matching and ranking.
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', text_chunk)) STORED;
+CREATE INDEX IF NOT EXISTS chunks_tsv_gin ON chunks USING gin (tsv);
+DROP INDEX IF EXISTS chunks_fts;
+
+-- Inner-product distance for unit vectors (supersedes the cosine index).
+-- The embedder now L2-normalizes queries, and for unit vectors cosine and
+-- (negated) inner product order identically - <#> skips the per-row
+-- sqrt/divide. Normalize the stored vectors once and rebuild the HNSW index
+-- with the matching opclass.
+UPDATE chunks SET embedding_h = l2_normalize(embedding_h);
+DROP INDEX IF EXISTS chunks_embedding_h_hnsw;
+CREATE INDEX chunks_embedding_h_hnsw
+    ON chunks USING hnsw (embedding_h halfvec_ip_ops)
+    WITH (m = 16, ef_construction = 64);
+
+-- Least-privilege role for LLM-generated SQL.
+-- query_relational_db executes whatever SQL the parser model produced, so it
+-- runs as a role that can only read the two tables. The retriever also sets
+-- statement_timeout per pooled connection so a pathological join cannot
+-- starve the pool.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT FROM pg_roles WHERE rolname = 'bot_ro') THEN
+        CREATE ROLE bot_ro NOINHERIT;
+    END IF;
+END
+$$;
+GRANT SELECT ON events, chunks TO bot_ro;
+-- The retriever switches with SET ROLE (SET SESSION AUTHORIZATION needs a
+-- superuser login, which Neon never grants), and SET ROLE requires the app's
+-- login role to be a member of bot_ro. Run this file as that login role;
+-- CURRENT_USER then resolves to it.
+GRANT bot_ro TO CURRENT_USER;
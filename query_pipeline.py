@@ -1,10 +1,15 @@
 import sys, os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+import asyncio
+import datetime
 import json
 import re
 import sys
+import threading
+import numpy as np
 import google.generativeai as genai
+from collections import OrderedDict
 from typing import Dict, Any
 import textwrap
 
@@ -53,101 +58,462 @@ except Exception as e:
 
 # --- END OF CONFIGURATION ---
 
+GEMINI_MODEL_NAME = 'gemini-2.5-flash-preview-09-2025'
+
 try:
-    generation_model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025')
+    generation_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 except Exception as e:
     print(f"ERROR: Could not initialize Gemini model: {e}", file=sys.stderr); sys.exit(1)
 
+# --- Prompt Prefixes ---
+# Both prompts split into an invariant prefix (schema, rules, instructions -
+# identical on every turn) and a tiny per-turn suffix. The prefixes are
+# uploaded once to Gemini's context cache below, so each call pays only for
+# the suffix tokens.
+
+_CURRENT_YEAR = 2025 # Assuming current year for context
+
+# Shared by the parsing prompt and the tool-calling agent prompt below.
+DB_SCHEMA_BLOCK = textwrap.dedent("""
+--- DATABASE SCHEMA ---
+
+Table: 'events' (Structured Facts)
+Columns: [
+    event_id (TEXT, PK, e.g., 'Circuit Craft'),
+    name_of_event (TEXT),
+    club_name (TEXT, e.g., 'BIONARY'),
+    event_domain (TEXT, e.g., 'Hardware / IoT', 'AI / ML', 'Design / 3D Modeling', 'Hackathon / AI / Robotics'),
+    date_of_event (DATE, format YYYY-MM-DD),
+    time_of_event (TEXT),
+    faculty_coordinators (TEXT),
+    student_coordinators (TEXT),
+    venue (TEXT),
+    mode_of_event (TEXT, e.g., 'Offline', 'Online'),
+    registration_fee (TEXT),
+    speakers (TEXT),
+    perks (TEXT)
+]
+
+Table: 'chunks' (Semantic Search)
+Columns: [
+    text_chunk (TEXT, e.g., 'A beginner friendly workshop...'),
+    embedding (VECTOR)
+]
+(Contains event descriptions, highlights, perks, club, and domain)
+""")
+
+# This prompt is aware of the new `club_name` and `event_domain` columns.
+PARSING_PROMPT_PREFIX = textwrap.dedent(f"""
+You are a query-parsing agent for a university club's knowledge base.
+Your job is to convert a user's question into a JSON object, choosing the best tool.
+
+You have two tools:
+1. Relational DB (PostgreSQL) for structured facts (who, when, how many, list all).
+2. Vector DB (pgvector) for conceptual/descriptive questions (what, tell me about, topic search).
+{DB_SCHEMA_BLOCK}
+--- JSON OUTPUT FORMAT ---
+{{"intent": "semantic", "query": "text to search for"}}
+OR
+{{"intent": "structured", "query": "SELECT ... FROM events WHERE ..."}}
+
+--- RULES ---
+
+1.  **Use SQL for Departments/Domains:** To find events by department (e.g., "robotics", "AI", "hardware"), you **MUST** query the `event_domain` column.
+    (e.g., `event_domain ILIKE '%robotics%'`)
+
+2.  **Prioritize SQL for Facts:** You **MUST** use "intent: structured" for any other specific facts:
+    - "Who" (e.g., 'speakers', 'faculty_coordinators')
+    - "When" (e.g., 'date_of_event')
+    - "How many" (e.g., `COUNT(event_id)`)
+    - "List all" (e.g., `SELECT name_of_event FROM events`)
+
+3.  **Use Semantic Search:** Use "intent: semantic" ONLY for conceptual or descriptive questions:
+    - "What is RAG?"
+    - "Tell me about..."
+    - "What did the Arduino workshop cover?"
+
+4.  **SQL Syntax:**
+    - Use `ILIKE` for case-insensitive string matching.
+    - Use `EXTRACT(YEAR FROM date_of_event)` to get the year.
+    - Assume 'this year' is {_CURRENT_YEAR}, 'last year' is {_CURRENT_YEAR - 1}.
+
+---
+""")
+
+# This prompt is "SQL-aware" and "helpful"
+FINAL_PROMPT_PREFIX = textwrap.dedent("""
+You are the 'Club Knowledge Search Agent'. Your job is to synthesize a final answer
+from the provided context. You MUST answer the user's question.
+
+You are given the user's question, the retrieved context, and (if applicable)
+the SQL query that was run to get that context.
+
+INSTRUCTIONS:
+1.  **If the Context is a Database Result (e.g., `Database query returned: [(1,)]`):**
+    * Look at the 'SQL Query' and the 'Context' *together*.
+    * If the query was `SELECT COUNT...` and the result is `[(1,)]`, the answer is 1.
+    * If the query was `SELECT COUNT...` and the result is `[(0,)]`, the answer is 0.
+    * Synthesize the raw SQL result into a natural, human-readable sentence.
+    * **Example:** If query was `SELECT COUNT...` and result is `[(1,)]` and question was "How many robotics events...", answer "There was 1 robotics event."
+    * **Example:** If query was `SELECT speakers...` and result is `[('Dr. A',), ('Dr. B',)]`, answer "The speakers were Dr. A and Dr. B."
+    * If the result is `[('No results found for that query.',)]` or `[]` or `[('',)]`, state "I do not have that information in my records."
+
+2.  **If the Context is Semantic Text (from vector search):**
+    * Read the text chunks to find the answer.
+    * **Be helpful:** If the user asks about a specific topic (e.g., "RAG"), and the context shows an event *mentions* that topic (even in 'perks' or 'highlights'), you **MUST** state that you found a mention and present the details (e.g., "Yes, the 'From Voice to Notes' event mentioned RAG in its perks...").
+    * If the answer is not in the text, state "I do not have that information in my records."
+
+3.  **Do not make up information.** Answer ONLY from the context.
+
+---
+""")
+
+def _try_create_cached_model(prefix: str, label: str):
+    """Uploads an invariant prompt prefix to Gemini's context cache and returns
+    a model bound to it, or None when caching is unavailable (e.g. the prefix
+    is below the cacheable minimum or the API rejects it)."""
+    try:
+        cached = genai.caching.CachedContent.create(
+            model=GEMINI_MODEL_NAME, contents=[prefix], ttl=datetime.timedelta(hours=1))
+        print(f"[Config] Gemini context cache ready for the {label} prompt.")
+        return genai.GenerativeModel.from_cached_content(cached_content=cached)
+    except Exception as e:
+        print(f"[Config] Context caching unavailable for the {label} prompt ({e}). Sending full prompts.")
+        return None
+
+_parser_model = _try_create_cached_model(PARSING_PROMPT_PREFIX, "parsing")
+_final_model = _try_create_cached_model(FINAL_PROMPT_PREFIX, "final-answer")
+
+# --- Single-Call Agent (function calling) ---
+# Instead of two separate Gemini calls (parse, then synthesize), the agent
+# model decides in ONE conversation whether to call run_sql or
+# semantic_search; the retriever result goes back into the same session and
+# the model answers directly. One prompt prefix, one conversation, and the
+# second request reuses the session instead of resending everything.
+
+AGENT_SYSTEM_PROMPT = textwrap.dedent(f"""
+You are the 'Club Knowledge Search Agent' for a university club's knowledge base.
+Answer the user's question by first fetching evidence with exactly one tool call:
+
+1. run_sql(sql): read-only PostgreSQL SELECT for structured facts
+   (who, when, how many, list all).
+2. semantic_search(query): hybrid vector+keyword search over event
+   description chunks for conceptual/descriptive questions
+   (what is..., tell me about...).
+{DB_SCHEMA_BLOCK}
+--- TOOL RULES ---
+
+1.  **Use run_sql for Departments/Domains:** To find events by department (e.g., "robotics", "AI", "hardware"), you **MUST** query the `event_domain` column (e.g., `event_domain ILIKE '%robotics%'`).
+2.  **Prioritize run_sql for Facts:** "Who", "When", "How many", "List all".
+3.  **Use semantic_search** ONLY for conceptual or descriptive questions.
+4.  **SQL Syntax:** Use `ILIKE` for case-insensitive matching and
+    `EXTRACT(YEAR FROM date_of_event)` for years. Assume 'this year' is
+    {_CURRENT_YEAR}, 'last year' is {_CURRENT_YEAR - 1}.
+
+--- ANSWER RULES ---
+
+1.  Synthesize raw SQL results into a natural, human-readable sentence
+    (e.g. result [('Dr. A',), ('Dr. B',)] -> "The speakers were Dr. A and Dr. B.").
+2.  For semantic text, be helpful: if the context merely *mentions* the
+    user's topic (even in perks or highlights), say you found a mention and
+    present the details.
+3.  If the tool result is empty or unhelpful, state "I do not have that
+    information in my records."
+4.  **Do not make up information.** Answer ONLY from the tool result.
+""")
+
+_AGENT_TOOLS = genai.protos.Tool(function_declarations=[
+    genai.protos.FunctionDeclaration(
+        name="run_sql",
+        description="Execute a read-only SQL SELECT against the events table for structured facts.",
+        parameters=genai.protos.Schema(
+            type=genai.protos.Type.OBJECT,
+            properties={"sql": genai.protos.Schema(type=genai.protos.Type.STRING)},
+            required=["sql"])),
+    genai.protos.FunctionDeclaration(
+        name="semantic_search",
+        description="Hybrid vector+keyword search over event description chunks for conceptual questions.",
+        parameters=genai.protos.Schema(
+            type=genai.protos.Type.OBJECT,
+            properties={"query": genai.protos.Schema(type=genai.protos.Type.STRING)},
+            required=["query"])),
+])
+
+try:
+    agent_model = genai.GenerativeModel(
+        GEMINI_MODEL_NAME, tools=[_AGENT_TOOLS], system_instruction=AGENT_SYSTEM_PROMPT)
+except Exception as e:
+    print(f"[Config] Function-calling agent unavailable ({e}); using the two-call pipeline.", file=sys.stderr)
+    agent_model = None
+
+def _agent_turn(user_question: str, query_embedding, stream: bool = False):
+    """Runs one tool-calling conversation. Returns (response, streaming):
+    when streaming is True the response is a chunk iterator, otherwise a
+    complete response. Raises on API errors; callers fall back to the
+    two-call pipeline."""
+    chat = agent_model.start_chat(enable_automatic_function_calling=False)
+    response = chat.send_message(f'User Question: "{user_question}"')
+
+    # The tool call is not always the first part: Gemini may emit a text part
+    # ("Let me look that up...") ahead of the function_call part
+    parts = response.candidates[0].content.parts
+    fc = next((p.function_call for p in parts if p.function_call.name), None)
+    if fc is None:
+        # The model answered without fetching evidence (e.g. a greeting)
+        return response, False
+
+    print(f"[Pipeline] Agent tool call: {fc.name}({dict(fc.args)})")
+    if fc.name == "run_sql":
+        rows = member3_retriever.query_relational_db(dict(fc.args).get("sql", ""))
+        payload = {"result": repr(rows)}
+    elif fc.name == "semantic_search":
+        tool_query = dict(fc.args).get("query", user_question)
+        # The raw question's embedding is only reusable when the model didn't
+        # rephrase the query
+        docs = member3_retriever.query_vector_db(
+            tool_query,
+            query_embedding=query_embedding if tool_query == user_question else None)
+        payload = {"documents": list(docs)}
+    else:
+        payload = {"error": f"Unknown tool: {fc.name}"}
+
+    response = chat.send_message(
+        genai.protos.Content(parts=[genai.protos.Part(
+            function_response=genai.protos.FunctionResponse(name=fc.name, response=payload))]),
+        stream=stream)
+    return response, stream
+
+# --- Semantic Answer Cache ---
+# Chat sessions repeat near-duplicate questions ("what is RAG?", "tell me
+# about RAG"). If a new question embeds within SEMANTIC_CACHE_THRESHOLD cosine
+# similarity of a previously answered one, the cached final answer is returned
+# and both Gemini calls plus the DB round trip are skipped entirely.
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_ENTRIES = 1024
+
+_semantic_cache = OrderedDict() # {entry_id: (unit_embedding, answer)}, LRU order
+_semantic_cache_lock = threading.Lock()
+_semantic_cache_next_id = 0
+
+def _semantic_cache_lookup(query_embedding):
+    """Returns the cached answer closest to `query_embedding`, or None."""
+    norm = np.linalg.norm(query_embedding)
+    if norm == 0: return None
+    unit = query_embedding / norm
+    with _semantic_cache_lock:
+        if not _semantic_cache: return None
+        keys = list(_semantic_cache.keys())
+        sims = np.stack([emb for emb, _ in _semantic_cache.values()]) @ unit
+        best = int(np.argmax(sims))
+        if sims[best] > SEMANTIC_CACHE_THRESHOLD:
+            _semantic_cache.move_to_end(keys[best])
+            return _semantic_cache[keys[best]][1]
+    return None
+
+def _semantic_cache_store(query_embedding, answer: str):
+    """Stores an answer under its question embedding, evicting LRU entries."""
+    global _semantic_cache_next_id
+    norm = np.linalg.norm(query_embedding)
+    if norm == 0: return
+    with _semantic_cache_lock:
+        _semantic_cache[_semantic_cache_next_id] = (query_embedding / norm, answer)
+        _semantic_cache_next_id += 1
+        while len(_semantic_cache) > SEMANTIC_CACHE_MAX_ENTRIES:
+            _semantic_cache.popitem(last=False)
+
+# --- Parse Cache ---
+# Exact-match LRU for the parse step: an identical question skips the parse
+# LLM call. (The semantic cache above short-circuits whole *answers* for
+# near-duplicates; this still helps when the answer was blocked or evicted.)
+PARSE_CACHE_MAX_ENTRIES = 512
+_parse_cache = OrderedDict() # {question: parsed intent dict}
+_parse_cache_lock = threading.Lock()
+
 # --- Main Pipeline Logic ---
 
+# Compiled once: re.search(pattern, ...) re-looks-up its cache on every call
+_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+
 def _parse_json_from_response(text: str) -> Dict[str, Any]:
     """Extracts a JSON object from a model's text response."""
-    match = re.search(r"\{.*\}", text, re.DOTALL)
+    match = _JSON_RE.search(text)
     if not match: print(f"Error: No JSON found in response: {text}"); return {"intent": "error", "query": "Could not parse."}
     json_str = match.group(0)
     try: return json.loads(json_str)
     except json.JSONDecodeError as e: print(f"Error: Invalid JSON: {e}\nRaw: {json_str}"); return {"intent": "error", "query": "Invalid JSON."}
 
 def handle_user_query(user_question: str) -> str:
-    """Main function to handle the end-to-end query pipeline."""
-    current_year = 2025 # Assuming current year for context
+    """Main function to handle the end-to-end query pipeline (non-streaming)."""
+    query_embedding = member3_retriever.embed_query(user_question)
+    if query_embedding is not None:
+        cached_answer = _semantic_cache_lookup(query_embedding)
+        if cached_answer is not None:
+            print(f"[Pipeline] Semantic cache hit for: '{user_question}'")
+            return cached_answer
+
+    if agent_model is not None:
+        try:
+            response, _ = _agent_turn(user_question, query_embedding)
+            if response.prompt_feedback.block_reason:
+                return f"Sorry, the response was blocked. Reason: {response.prompt_feedback.block_reason}"
+            if query_embedding is not None:
+                _semantic_cache_store(query_embedding, response.text)
+            return response.text
+        except Exception as e:
+            print(f"Error during agent turn: {e}. Falling back to the two-call pipeline.")
 
-    # --- 1. Parse the Query (1st Gemini Call) ---
+    return asyncio.run(_handle_user_query_async(user_question, query_embedding))
 
-    # --- *** FINAL UPDATED PROMPT *** ---
-    # This prompt is aware of the new `club_name` and `event_domain` columns.
-    parsing_prompt = textwrap.dedent(f"""
-    You are a query-parsing agent for a university club's knowledge base.
-    Your job is to convert a user's question into a JSON object, choosing the best tool.
-
-    You have two tools:
-    1. Relational DB (PostgreSQL) for structured facts (who, when, how many, list all).
-    2. Vector DB (pgvector) for conceptual/descriptive questions (what, tell me about, topic search).
-
-    --- DATABASE SCHEMA ---
-
-    Table: 'events' (Structured Facts)
-    Columns: [
-        event_id (TEXT, PK, e.g., 'Circuit Craft'),
-        name_of_event (TEXT),
-        club_name (TEXT, e.g., 'BIONARY'),
-        event_domain (TEXT, e.g., 'Hardware / IoT', 'AI / ML', 'Design / 3D Modeling', 'Hackathon / AI / Robotics'),
-        date_of_event (DATE, format YYYY-MM-DD),
-        time_of_event (TEXT),
-        faculty_coordinators (TEXT),
-        student_coordinators (TEXT),
-        venue (TEXT),
-        mode_of_event (TEXT, e.g., 'Offline', 'Online'),
-        registration_fee (TEXT),
-        speakers (TEXT),
-        perks (TEXT)
-    ]
-
-    Table: 'chunks' (Semantic Search)
-    Columns: [
-        text_chunk (TEXT, e.g., 'A beginner friendly workshop...'),
-        embedding (VECTOR)
-    ]
-    (Contains event descriptions, highlights, perks, club, and domain)
-
-    --- JSON OUTPUT FORMAT ---
-    {{"intent": "semantic", "query": "text to search for"}}
-    OR
-    {{"intent": "structured", "query": "SELECT ... FROM events WHERE ..."}}
-
-    --- RULES ---
-
-    1.  **Use SQL for Departments/Domains:** To find events by department (e.g., "robotics", "AI", "hardware"), you **MUST** query the `event_domain` column.
-        (e.g., `event_domain ILIKE '%robotics%'`)
-
-    2.  **Prioritize SQL for Facts:** You **MUST** use "intent: structured" for any other specific facts:
-        - "Who" (e.g., 'speakers', 'faculty_coordinators')
-        - "When" (e.g., 'date_of_event')
-        - "How many" (e.g., `COUNT(event_id)`)
-        - "List all" (e.g., `SELECT name_of_event FROM events`)
-
-    3.  **Use Semantic Search:** Use "intent: semantic" ONLY for conceptual or descriptive questions:
-        - "What is RAG?"
-        - "Tell me about..."
-        - "What did the Arduino workshop cover?"
-
-    4.  **SQL Syntax:**
-        - Use `ILIKE` for case-insensitive string matching.
-        - Use `EXTRACT(YEAR FROM date_of_event)` to get the year.
-        - Assume 'this year' is {current_year}, 'last year' is {current_year - 1}.
+async def _handle_user_query_async(user_question: str, query_embedding=None) -> str:
+    """Non-streaming two-call pipeline: used by the CLI loop and as the
+    fallback when the function-calling agent is unavailable."""
+    direct_answer, final_suffix, query_embedding = await _prepare_final_call(user_question, query_embedding)
+    if direct_answer is not None:
+        return direct_answer
 
-    ---
+    print("[Pipeline] Generating final answer...")
+    try:
+        if _final_model is not None:
+            # Instructions live in the server-side cache; send only the suffix
+            final_response = await _final_model.generate_content_async(final_suffix)
+        else:
+            final_response = await generation_model.generate_content_async(FINAL_PROMPT_PREFIX + final_suffix)
+        if final_response.prompt_feedback.block_reason:
+             return f"Sorry, the response was blocked. Reason: {final_response.prompt_feedback.block_reason}"
+        if query_embedding is not None:
+            _semantic_cache_store(query_embedding, final_response.text)
+        return final_response.text
+    except Exception as e: print(f"Error during Gemini final response: {e}"); return "Sorry, I had trouble formulating a response."
 
-    User Question: "{user_question}"
-    JSON Output:
-    """)
-    # --- *** END OF PROMPT UPDATE *** ---
+def stream_answer(user_question: str):
+    """Generator for st.write_stream: yields the final answer incrementally.
+
+    Cache hits and pipeline errors yield one complete message. The successful
+    path runs the single-conversation agent (two-call pipeline as fallback),
+    yields Gemini tokens as they arrive - time-to-first-token instead of
+    full-response latency - and stores the assembled answer in the semantic
+    cache once the stream ends."""
+    query_embedding = member3_retriever.embed_query(user_question)
+    if query_embedding is not None:
+        cached_answer = _semantic_cache_lookup(query_embedding)
+        if cached_answer is not None:
+            print(f"[Pipeline] Semantic cache hit for: '{user_question}'")
+            yield cached_answer
+            return
+
+    if agent_model is not None:
+        yielded_any = False
+        try:
+            response, streaming = _agent_turn(user_question, query_embedding, stream=True)
+            pieces = []
+            if streaming:
+                for chunk in response:
+                    if chunk.text:
+                        pieces.append(chunk.text)
+                        yielded_any = True
+                        yield chunk.text
+            elif response.text:
+                pieces.append(response.text)
+                yielded_any = True
+                yield response.text
+            full_answer = "".join(pieces)
+            if query_embedding is not None and full_answer:
+                _semantic_cache_store(query_embedding, full_answer)
+            return
+        except Exception as e:
+            if yielded_any:
+                # Part of the answer is already on screen; a restart would
+                # duplicate it, so apologize instead of falling back
+                print(f"Error during agent turn: {e}.")
+                yield "Sorry, I had trouble formulating a response."
+                return
+            print(f"Error during agent turn: {e}. Falling back to the two-call pipeline.")
+
+    direct_answer, final_suffix, query_embedding = asyncio.run(
+        _prepare_final_call(user_question, query_embedding))
+    if direct_answer is not None:
+        yield direct_answer
+        return
+
+    print("[Pipeline] Generating final answer (streaming)...")
+    pieces = []
+    try:
+        if _final_model is not None:
+            stream = _final_model.generate_content(final_suffix, stream=True)
+        else:
+            stream = generation_model.generate_content(FINAL_PROMPT_PREFIX + final_suffix, stream=True)
+        for chunk in stream:
+            if chunk.text:
+                pieces.append(chunk.text)
+                yield chunk.text
+    except Exception as e:
+        print(f"Error during Gemini final response: {e}")
+        yield "Sorry, I had trouble formulating a response."
+        return
+    full_answer = "".join(pieces)
+    if query_embedding is not None and full_answer:
+        _semantic_cache_store(query_embedding, full_answer)
+
+async def _prepare_final_call(user_question: str, query_embedding=None):
+    """Shared front half of the two-call pipeline: semantic cache check, query
+    parse and retrieval. Returns (direct_answer, final_prompt_suffix,
+    query_embedding); when direct_answer is not None the turn is already
+    decided (cache hit or pipeline error) and no final Gemini call is needed.
+
+    The Gemini parse call and a speculative hybrid retrieval on the raw
+    question run concurrently, then the parsed intent decides which result to
+    keep. Saves roughly one network RTT per semantic turn."""
+    # --- 0. Semantic Cache Check ---
+    # The embedding is computed once and reused by the hybrid retrieval;
+    # callers that already embedded (and checked the cache) pass it in.
+    if query_embedding is None:
+        query_embedding = await asyncio.to_thread(member3_retriever.embed_query, user_question)
+        if query_embedding is not None:
+            cached_answer = _semantic_cache_lookup(query_embedding)
+            if cached_answer is not None:
+                print(f"[Pipeline] Semantic cache hit for: '{user_question}'")
+                return cached_answer, None, None
+
+    # --- 1. Parse the Query (1st Gemini Call) ---
+    parsing_suffix = f'User Question: "{user_question}"\nJSON Output:'
 
     print(f"\n[Pipeline] Parsing query: '{user_question}'")
-    try:
-        parser_response = generation_model.generate_content(parsing_prompt)
+    with _parse_cache_lock:
+        parsed_intent = _parse_cache.get(user_question)
+        if parsed_intent is not None: _parse_cache.move_to_end(user_question)
+
+    if parsed_intent is not None:
+        # Identical question seen before: no parse call; retrieve only if the
+        # known intent actually needs the hybrid search
+        print(f"[Pipeline] Parse cache hit for: '{user_question}'")
+        speculative_docs = None
+        if parsed_intent.get("intent") == "semantic":
+            try:
+                speculative_docs = await asyncio.to_thread(
+                    member3_retriever.query_vector_db, user_question, query_embedding=query_embedding)
+            except Exception as e:
+                speculative_docs = e
+    else:
+        # The hybrid retrieval is speculative: it runs on the raw question while
+        # Gemini parses. If the intent comes back "semantic" the retrieval RTT has
+        # already been paid; if "structured" the docs are simply discarded.
+        if _parser_model is not None:
+            # Schema + rules live in the server-side cache; send only the suffix
+            parse_task = _parser_model.generate_content_async(parsing_suffix)
+        else:
+            parse_task = generation_model.generate_content_async(PARSING_PROMPT_PREFIX + parsing_suffix)
+        speculative_task = asyncio.to_thread(
+            member3_retriever.query_vector_db, user_question, query_embedding=query_embedding)
+        parser_response, speculative_docs = await asyncio.gather(parse_task, speculative_task, return_exceptions=True)
+
+        if isinstance(parser_response, Exception):
+            print(f"Error during Gemini query parsing: {parser_response}"); return "Sorry, I had trouble understanding.", None, None
         parsed_intent = _parse_json_from_response(parser_response.text)
-    except Exception as e: print(f"Error during Gemini query parsing: {e}"); return "Sorry, I had trouble understanding."
+        if parsed_intent.get("intent") != "error":
+            with _parse_cache_lock:
+                _parse_cache[user_question] = parsed_intent
+                while len(_parse_cache) > PARSE_CACHE_MAX_ENTRIES:
+                    _parse_cache.popitem(last=False)
     print(f"[Pipeline] Parsed Intent: {parsed_intent}")
 
     # --- 2. Retrieve Data ---
@@ -159,29 +525,22 @@ def handle_user_query(user_question: str) -> str:
 
     if intent == "semantic":
         if not query: context = "Parser error: Missing query text for semantic search."
-        # Call the hybrid search function
-        else: context_docs = member3_retriever.query_vector_db(query); context = "\n".join(context_docs)
+        elif isinstance(speculative_docs, Exception):
+            print(f"Error during speculative retrieval: {speculative_docs}")
+            context = "Retrieval error: could not search the knowledge base."
+        # Reuse the docs already fetched for the raw question
+        else: context = "\n".join(speculative_docs)
     elif intent == "structured":
         if not query: context = "Parser error: Missing SQL query for structured search."
         else:
             sql_query_for_prompt = query # <-- Store the query
-            sql_results = member3_retriever.query_relational_db(query)
+            sql_results = await asyncio.to_thread(member3_retriever.query_relational_db, query)
             context = f"Database query returned: {sql_results}"
     else: context = f"Query parser failed or returned unknown intent: {intent}"
     print(f"[Pipeline] Retrieved Context: {context[:300]}...") # Print longer snippet
 
     # --- 3. Generate Final Response (2nd Gemini Call) ---
-
-    # --- *** FINAL PROMPT FIX *** ---
-    # This prompt is now "SQL-aware" and "helpful"
-    final_prompt = textwrap.dedent(f"""
-    You are the 'Club Knowledge Search Agent'. Your job is to synthesize a final answer
-    from the provided context. You MUST answer the user's question.
-
-    You are given the user's question, the retrieved context, and (if applicable)
-    the SQL query that was run to get that context.
-
-    ---
+    final_suffix = textwrap.dedent(f"""
     User Question:
     {user_question}
     ---
@@ -192,34 +551,10 @@ def handle_user_query(user_question: str) -> str:
     {sql_query_for_prompt if sql_query_for_prompt else 'N/A'}
     ---
 
-    INSTRUCTIONS:
-    1.  **If the Context is a Database Result (e.g., `Database query returned: [(1,)]`):**
-        * Look at the 'SQL Query' and the 'Context' *together*.
-        * If the query was `SELECT COUNT...` and the result is `[(1,)]`, the answer is 1.
-        * If the query was `SELECT COUNT...` and the result is `[(0,)]`, the answer is 0.
-        * Synthesize the raw SQL result into a natural, human-readable sentence.
-        * **Example:** If query was `SELECT COUNT...` and result is `[(1,)]` and question was "How many robotics events...", answer "There was 1 robotics event."
-        * **Example:** If query was `SELECT speakers...` and result is `[('Dr. A',), ('Dr. B',)]`, answer "The speakers were Dr. A and Dr. B."
-        * If the result is `[('No results found for that query.',)]` or `[]` or `[('',)]`, state "I do not have that information in my records."
-
-    2.  **If the Context is Semantic Text (from vector search):**
-        * Read the text chunks to find the answer.
-        * **Be helpful:** If the user asks about a specific topic (e.g., "RAG"), and the context shows an event *mentions* that topic (even in 'perks' or 'highlights'), you **MUST** state that you found a mention and present the details (e.g., "Yes, the 'From Voice to Notes' event mentioned RAG in its perks...").
-        * If the answer is not in the text, state "I do not have that information in my records."
-
-    3.  **Do not make up information.** Answer ONLY from the context.
-
     Final Answer:
     """)
-    # --- *** END OF PROMPT FIX *** ---
 
-    print("[Pipeline] Generating final answer...")
-    try:
-        final_response = generation_model.generate_content(final_prompt)
-        if final_response.prompt_feedback.block_reason:
-             return f"Sorry, the response was blocked. Reason: {final_response.prompt_feedback.block_reason}"
-        return final_response.text
-    except Exception as e: print(f"Error during Gemini final response: {e}"); return "Sorry, I had trouble formulating a response."
+    return None, final_suffix, query_embedding
 
 # --- 4. Interactive Chat Loop ---
 if __name__ == "__main__":
@@ -1,154 +1,404 @@
-%%writefile retriever.py
-import os
-import sys
-import psycopg2
-import google.colab.userdata
-from typing import List, Tuple, Set
-from pgvector.psycopg2 import register_vector
-from sentence_transformers import SentenceTransformer
-
-# --- CONFIGURATION ---
-MODEL_NAME = 'BAAI/bge-base-en-v1.5'
-QUERY_PREFIX = "Represent this sentence for searching relevant passages: "
-# Number of results to fetch from each search type
-TOP_K = 5 # Fetch 5 from vector, 5 from keyword
-
-# 1. Load the model.
-try:
-    print(f"[Retriever] Loading sentence-transformer model '{MODEL_NAME}'...")
-    # Add trust_remote_code=True if needed by the specific model version
-    try:
-        model = SentenceTransformer(MODEL_NAME, trust_remote_code=True)
-    except Exception as e:
-        print(f"Failed loading with trust_remote_code=True, trying without: {e}", file=sys.stderr)
-        model = SentenceTransformer(MODEL_NAME)
-
-    # Verify model dimension
-    actual_dimension = model.get_sentence_embedding_dimension()
-    if actual_dimension != 768:
-        print(f"--- FATAL ERROR --- \nModel '{MODEL_NAME}' loaded with wrong dimension!", file=sys.stderr)
-        print(f"Expected 768, but got {actual_dimension}", file=sys.stderr)
-        model = None
-    else:
-        print(f"[Retriever] Model loaded successfully (768 dimensions).")
-
-except Exception as e:
-    print(f"ERROR: Could not load sentence-transformer model: {e}", file=sys.stderr)
-    model = None
-
-def _connect_to_db():
-    """Connects to the Neon DB using the Colab secret."""
-    try:
-        conn_string = google.colab.userdata.get('NEON_DB_URL')
-        if conn_string is None:
-            print("ERROR: [Retriever] 'NEON_DB_URL' secret not found.", file=sys.stderr)
-            return None
-        conn = psycopg2.connect(conn_string)
-        return conn
-    except Exception as e:
-        print(f"ERROR: [Retriever] Unable to connect to database: {e}", file=sys.stderr)
-        return None
-
-# --- Relational DB Query ---
-def query_relational_db(sql_query: str) -> List[Tuple]:
-    """ Executes a read-only SQL query against the Neon (PostgreSQL) database. """
-    print(f"[Retriever] Received SQL query: '{sql_query}'")
-    conn = _connect_to_db()
-    if conn is None: return [("Database connection error.",)]
-    results = []
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql_query)
-            if cur.description: results = cur.fetchall()
-            else: results = []
-    except (psycopg2.Error, Exception) as e:
-        print(f"ERROR: [Retriever] SQL query failed: {e}", file=sys.stderr)
-        conn.rollback(); results = [(f"SQL error: {e}",)]
-    finally:
-        if conn: conn.close()
-    if not results: return [("No results found for that query.",)]
-    return results
-
-# --- Vector DB Query (Hybrid Search) ---
-def query_vector_db(query_text: str) -> List[str]:
-    """
-    Performs HYBRID search (Vector + Keyword) against the Neon database.
-    """
-    if model is None: return ["Error: SentenceTransformer model is not loaded."]
-
-    print(f"[Retriever] Received SEMANTIC query for: '{query_text}'")
-    conn = _connect_to_db()
-    if conn is None: return ["Database connection error."]
-
-    # Use a dictionary to store results and their ranks for re-ranking
-    # { text_chunk: rank } - lower rank is better
-    combined_results_map = {}
-
-    # --- 1. Vector Search ---
-    print("[Retriever] Performing vector search...")
-    try:
-        query_with_prefix = QUERY_PREFIX + query_text
-        query_embedding = model.encode(query_with_prefix)
-        with conn.cursor() as cur:
-            register_vector(cur)
-            cur.execute(
-                f"""
-                SELECT text_chunk, embedding <-> %s AS distance
-                FROM chunks
-                ORDER BY distance
-                LIMIT {TOP_K};
-                """,
-                (query_embedding,)
-            )
-            rows = cur.fetchall()
-            for i, row in enumerate(rows):
-                combined_results_map[row[0]] = i # Rank 0, 1, 2, 3, 4
-            print(f"[Retriever] Vector search found {len(rows)} results.")
-
-    except (psycopg2.Error, Exception) as e:
-        print(f"ERROR: [Retriever] Vector query failed: {e}", file=sys.stderr)
-        conn.rollback()
-
-    # --- 2. Keyword Search (Full-Text Search) ---
-    print("[Retriever] Performing keyword search...")
-    try:
-        if conn.closed: # Reconnect if vector search failed and rolled back
-             conn = _connect_to_db()
-             if conn is None: raise Exception("Reconnect failed for keyword search")
-
-        with conn.cursor() as cur:
-            # Use `websearch_to_tsquery` - it's better for user queries and acronyms like "RAG"
-            keyword_query = """
-                SELECT text_chunk, ts_rank_cd(to_tsvector('english', text_chunk), query) AS rank
-                FROM chunks, websearch_to_tsquery('english', %s) query
-                WHERE query @@ to_tsvector('english', text_chunk)
-                ORDER BY rank DESC
-                LIMIT {TOP_K};
-            """
-            cur.execute(keyword_query, (query_text,))
-            rows = cur.fetchall()
-            for row in rows:
-                if row[0] not in combined_results_map:
-                    # Add keyword-only results with a lower priority (higher rank number)
-                    combined_results_map[row[0]] = 100
-            print(f"[Retriever] Keyword search found {len(rows)} results.")
-
-    except (psycopg2.Error, Exception) as e:
-        print(f"ERROR: [Retriever] Keyword query failed: {e}", file=sys.stderr)
-
-    finally:
-        if conn and not conn.closed:
-            conn.close()
-
-    # --- 3. Combine and Rank Results ---
-    # Sort by rank (lower is better), which prioritizes vector results
-    ranked_results = sorted(combined_results_map.keys(), key=lambda x: combined_results_map[x])
-
-    print(f"[Retriever] Combined search yields {len(ranked_results)} unique results.")
-
-    if not ranked_results:
-        return ["No relevant documents found."]
-
-    # Return the top 10 (or fewer) combined unique results
-
-    return ranked_results[:10]
+import json
+import os
+import sys
+import threading
+import numpy as np
+import psycopg
+import psycopg_pool
+from contextlib import contextmanager
+from typing import List, Tuple, Set
+from pgvector.psycopg import register_vector
+
+# --- Attempt to import Colab userdata module ---
+try:
+    from google.colab import userdata as _colab_userdata
+    _IN_COLAB = True
+except ImportError:
+    _colab_userdata = None
+    _IN_COLAB = False
+
+# --- CONFIGURATION ---
+MODEL_NAME = 'BAAI/bge-base-en-v1.5'
+QUERY_PREFIX = "Represent this sentence for searching relevant passages: "
+# Number of results to fetch from each search type
+TOP_K = 5 # Fetch 5 from vector, 5 from keyword
+RRF_K = 60 # Reciprocal Rank Fusion constant: score = weight / (RRF_K + rank)
+# Per-source fusion weights: vector ranks lead, but an exact keyword hit
+# (e.g. the acronym "RAG") can still win instead of being pinned below every
+# vector result
+VECTOR_RRF_WEIGHT = 1.0
+KEYWORD_RRF_WEIGHT = 0.7
+FUSED_TOP_K = 10 # Unique results returned after rank fusion
+# Connection pool bounds (Streamlit serves requests from a small thread pool)
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = 8
+# Directory holding an (optionally int8-quantized) ONNX export of the BGE model
+ONNX_MODEL_DIR = os.environ.get('BGE_ONNX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bge_onnx'))
+
+# 1. Load the model lazily, exactly once per process.
+# Streamlit re-runs scripts on every interaction, so a top-level
+# AutoModel.from_pretrained(...) call would re-trigger torch module init (hundreds
+# of MB) whenever this module gets re-imported. Instead, the model lives in a
+# process-level singleton behind a lock; first caller pays the load cost.
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+
+class _OnnxEmbedder:
+    """Thin SentenceTransformer-compatible wrapper around an ONNX export of BGE.
+
+    The FP32 PyTorch forward pass dominates retrieval latency for short
+    queries on the CPU host; the ONNX export (int8-quantized, dynamic) lets
+    onnxruntime use the CPU's int8 GEMM paths for a 2-4x speedup. Export once
+    with:
+
+        optimum-cli export onnx --model BAAI/bge-base-en-v1.5 bge_onnx/
+
+    and optionally quantize with optimum's ORTQuantizer
+    (AutoQuantizationConfig.avx512_vnni(is_static=False)). Pooling and L2
+    normalization happen here in NumPy instead of torch modules.
+    """
+
+    def __init__(self, model_dir):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        model_path = os.path.join(model_dir, 'model_quantized.onnx')
+        if not os.path.isfile(model_path):
+            model_path = os.path.join(model_dir, 'model.onnx')
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = onnxruntime.InferenceSession(model_path)
+        self._input_names = [i.name for i in self.session.get_inputs()]
+        # The search prefix never changes; tokenize its 9 tokens once and
+        # splice the user tokens in per query (see encode_query)
+        self._prefix_ids = self.tokenizer(QUERY_PREFIX, add_special_tokens=False)["input_ids"]
+        self._cls_id = self.tokenizer.cls_token_id
+        self._sep_id = self.tokenizer.sep_token_id
+
+    def get_sentence_embedding_dimension(self):
+        return 768
+
+    def _pool(self, hidden):
+        """[CLS] pooling (what BGE is trained with), L2-normalized.
+
+        Must match _TorchEmbedder.encode and the SentenceTransformer CLS
+        pooling that produced the stored chunk embeddings - mean pooling here
+        would put query vectors in a different embedding space.
+        """
+        embedding = hidden[0]
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def encode(self, text: str):
+        toks = self.tokenizer(text, return_tensors="np", truncation=True, max_length=512)
+        inputs = {name: toks[name].astype(np.int64) for name in self._input_names if name in toks}
+        hidden = self.session.run(None, inputs)[0] # (1, seq_len, 768)
+        return self._pool(hidden[0])
+
+    def encode_query(self, query_text: str):
+        """Encodes QUERY_PREFIX + query_text without re-tokenizing the prefix.
+
+        Builds [CLS] + cached prefix ids + user ids + [SEP] directly, so only
+        the user's few tokens go through the tokenizer per turn.
+        """
+        query_ids = self.tokenizer(query_text, add_special_tokens=False)["input_ids"]
+        ids = ([self._cls_id] + self._prefix_ids + query_ids)[:511] + [self._sep_id]
+        input_ids = np.array([ids], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": np.ones_like(input_ids)}
+        if "token_type_ids" in self._input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, inputs)[0]
+        return self._pool(hidden[0])
+
+class _TorchEmbedder:
+    """BGE through the bare transformers encoder, bfloat16, CLS pooling.
+
+    SentenceTransformer wraps the HF model in Python-level Pooling/Normalize
+    modules that each copy tensors per call. The bare AutoModel in bfloat16
+    halves memory traffic through the encoder on CPUs with AVX-512 BF16, and
+    pooling is one tensor slice: BGE is trained with [CLS] pooling, not mean.
+    BetterTransformer's fused kernels are applied when optimum is installed.
+    """
+
+    def __init__(self):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        model = AutoModel.from_pretrained(MODEL_NAME, torch_dtype=torch.bfloat16).eval()
+        try:
+            from optimum.bettertransformer import BetterTransformer
+            model = BetterTransformer.transform(model)
+        except Exception as e:
+            print(f"[Retriever] BetterTransformer unavailable ({e}); using the stock encoder.")
+        self.model = model
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.config.hidden_size
+
+    def encode(self, text: str):
+        toks = self.tokenizer(text, return_tensors="pt", truncation=True, max_length=512)
+        with self.torch.inference_mode():
+            out = self.model(**toks).last_hidden_state[:, 0] # [CLS] pooling
+            out = self.torch.nn.functional.normalize(out, dim=-1)
+        return out[0].float().numpy()
+
+def _load_model():
+    """Loads the BGE embedder: the ONNX export when present, else the bf16
+    transformers encoder. Returns the model or None on failure."""
+    if os.path.isdir(ONNX_MODEL_DIR):
+        try:
+            print(f"[Retriever] Loading ONNX BGE model from '{ONNX_MODEL_DIR}'...")
+            model = _OnnxEmbedder(ONNX_MODEL_DIR)
+            print("[Retriever] ONNX model loaded successfully (768 dimensions).")
+            return model
+        except Exception as e:
+            print(f"Failed loading ONNX model, falling back to transformers: {e}", file=sys.stderr)
+    try:
+        print(f"[Retriever] Loading transformers model '{MODEL_NAME}' (bfloat16)...")
+        model = _TorchEmbedder()
+
+        # Verify model dimension
+        actual_dimension = model.get_sentence_embedding_dimension()
+        if actual_dimension != 768:
+            print(f"--- FATAL ERROR --- \nModel '{MODEL_NAME}' loaded with wrong dimension!", file=sys.stderr)
+            print(f"Expected 768, but got {actual_dimension}", file=sys.stderr)
+            return None
+        print(f"[Retriever] Model loaded successfully (768 dimensions).")
+        return model
+
+    except Exception as e:
+        print(f"ERROR: Could not load transformers model: {e}", file=sys.stderr)
+        return None
+
+def get_embedder():
+    """Returns the shared embedder instance, loading it on first use."""
+    global _model, _model_loaded
+    if not _model_loaded:
+        with _model_lock:
+            if not _model_loaded:
+                _model = _load_model()
+                _model_loaded = True
+    return _model
+
+# 2. Database connections come from a shared pool, built on first use.
+# Neon sits behind TCP+TLS, so a fresh connect per query costs tens of ms of
+# handshake on every chat turn; pooled connections pay that once.
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_conn_string():
+    """Reads the Neon connection string from the Colab secret or the environment."""
+    if _IN_COLAB:
+        conn_string = _colab_userdata.get('NEON_DB_URL')
+        if conn_string: return conn_string
+    return os.environ.get('NEON_DB_URL')
+
+def _configure_conn(conn):
+    """Applied to every pooled connection as it is created.
+
+    The bot only ever reads, and its SQL comes from an LLM: run as the
+    read-only bot_ro role with tight timeouts so a pathological query
+    (a runaway cartesian join, a forgotten transaction) can't hold a pool
+    slot hostage. The pgvector adapter is registered here too: register_vector
+    looks up the vector type OID with a catalog query, so doing it per request
+    cost one extra round trip on every semantic turn.
+    """
+    register_vector(conn)
+    try:
+        # SET ROLE, not SET SESSION AUTHORIZATION: the latter needs a
+        # superuser login, which Neon never grants. SET ROLE only needs the
+        # login role to be a member of bot_ro (granted in db_migrations.sql).
+        conn.execute("SET ROLE bot_ro")
+    except psycopg.Error as e:
+        conn.rollback()
+        print(f"WARNING: [Retriever] Could not switch to role 'bot_ro' ({e}); staying on the login role.", file=sys.stderr)
+    conn.execute("SET statement_timeout = '3s'")
+    conn.execute("SET idle_in_transaction_session_timeout = '5s'")
+    conn.execute("SET default_transaction_read_only = on")
+    conn.commit()
+
+def _get_pool():
+    """Returns the shared psycopg_pool.ConnectionPool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                conn_string = _get_conn_string()
+                if conn_string is None:
+                    print("ERROR: [Retriever] 'NEON_DB_URL' secret not found.", file=sys.stderr)
+                    return None
+                try:
+                    _pool = psycopg_pool.ConnectionPool(
+                        conn_string, min_size=POOL_MIN_CONN, max_size=POOL_MAX_CONN,
+                        configure=_configure_conn)
+                    print(f"[Retriever] Connection pool ready ({POOL_MIN_CONN}-{POOL_MAX_CONN} connections).")
+                except Exception as e:
+                    print(f"ERROR: [Retriever] Unable to create connection pool: {e}", file=sys.stderr)
+                    return None
+    return _pool
+
+@contextmanager
+def _get_conn():
+    """Borrows a pooled connection; yields None if the pool is unavailable."""
+    pool = _get_pool()
+    if pool is None:
+        yield None
+        return
+    try:
+        conn = pool.getconn()
+    except Exception as e:
+        # psycopg_pool connects in the background, so an unreachable DB shows
+        # up here as a PoolTimeout rather than at pool construction
+        print(f"ERROR: [Retriever] Unable to get connection from pool: {e}", file=sys.stderr)
+        yield None
+        return
+    try:
+        yield conn
+    finally:
+        # End the implicit (read) transaction so the connection goes back clean
+        try: conn.rollback()
+        except Exception: pass
+        pool.putconn(conn)
+
+def _is_single_statement(sql_query: str) -> bool:
+    """True when the text is one SQL statement (a trailing ';' is allowed).
+
+    psycopg executes multi-statement strings as-is, and the SET ROLE /
+    read-only guards are session state that a second statement could simply
+    RESET before running its payload. Rejecting any interior ';' closes that
+    hole; the cost is refusing string literals that contain one, which the
+    queries this schema produces never need.
+    """
+    return ';' not in sql_query.strip().rstrip(';')
+
+# --- Relational DB Query ---
+def query_relational_db(sql_query: str) -> List[Tuple]:
+    """ Executes a read-only SQL query against the Neon (PostgreSQL) database. """
+    print(f"[Retriever] Received SQL query: '{sql_query}'")
+    if not _is_single_statement(sql_query):
+        print("ERROR: [Retriever] Rejected multi-statement SQL.", file=sys.stderr)
+        return [("Only a single SQL statement is allowed.",)]
+    results = []
+    with _get_conn() as conn:
+        if conn is None: return [("Database connection error.",)]
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql_query)
+                if cur.description: results = cur.fetchall()
+                else: results = []
+        except psycopg.errors.QueryCanceled:
+            print("ERROR: [Retriever] SQL query hit the statement timeout.", file=sys.stderr)
+            conn.rollback(); results = [("That query was too expensive to run. Please ask something narrower.",)]
+        except (psycopg.Error, Exception) as e:
+            print(f"ERROR: [Retriever] SQL query failed: {e}", file=sys.stderr)
+            conn.rollback(); results = [(f"SQL error: {e}",)]
+    if not results: return [("No results found for that query.",)]
+    return results
+
+# --- Embedding Serialization ---
+def _vec_literal(vec) -> str:
+    """Serializes an embedding as a pgvector text literal, e.g. '[0.1, 0.2]'.
+
+    For any future hand-built INSERT into chunks: json.dumps is a C-speed
+    serializer, unlike a per-element str() join. Prefer binary parameters
+    (register_vector + binary=True) on the query path, and
+    COPY ... WITH (FORMAT BINARY) with pgvector's binary codec for bulk loads.
+    """
+    return json.dumps(vec.tolist() if hasattr(vec, 'tolist') else list(vec))
+
+# --- Query Embedding ---
+def embed_query(query_text: str, model=None):
+    """Embeds a query with the BGE search prefix, L2-normalized.
+
+    Unit-length vectors let the DB use the pure-dot-product operator <#>
+    (for unit vectors cosine and negated inner product order identically,
+    minus the per-row sqrt/divide). Returns None if the model is unavailable.
+    """
+    if model is None: model = get_embedder()
+    if model is None: return None
+    if hasattr(model, 'encode_query'):
+        # ONNX path: the prefix tokens are pre-tokenized and fused in
+        return model.encode_query(query_text)
+    embedding = model.encode(QUERY_PREFIX + query_text)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else embedding
+
+# --- Vector DB Query (Hybrid Search) ---
+def query_vector_db(query_text: str, model=None, query_embedding=None) -> List[str]:
+    """
+    Performs HYBRID search (Vector + Keyword) against the Neon database.
+
+    Both searches run inside ONE SQL statement: two CTEs rank the vector and
+    keyword hits, and Reciprocal Rank Fusion (1 / (RRF_K + rank)) merges them
+    on the DB side, so each chat turn costs a single round trip to Neon.
+
+    `model` lets callers pass an already-cached embedder (e.g. Streamlit's
+    st.cache_resource instance); otherwise the shared singleton is used.
+    `query_embedding` lets callers reuse an embedding they already computed
+    (see embed_query) instead of paying a second encoder forward pass.
+    """
+    print(f"[Retriever] Received SEMANTIC query for: '{query_text}'")
+    if query_embedding is None:
+        query_embedding = embed_query(query_text, model)
+    if query_embedding is None: return ["Error: embedding model is not loaded."]
+
+    # Use `websearch_to_tsquery` - it's better for user queries and acronyms like "RAG"
+    # All limits and the RRF constant are bound as parameters - never
+    # interpolated into the SQL string (a literal '{TOP_K}' once shipped here
+    # because the string silently wasn't an f-string).
+    hybrid_query = """
+        WITH vector_hits AS (
+            SELECT text_chunk,
+                   row_number() OVER (ORDER BY embedding_h <#> %s::halfvec) AS rank,
+                   %s::float8 AS weight
+            FROM chunks
+            ORDER BY embedding_h <#> %s::halfvec
+            LIMIT %s
+        ),
+        keyword_hits AS (
+            SELECT text_chunk,
+                   row_number() OVER (ORDER BY ts_rank_cd(tsv, query) DESC) AS rank,
+                   %s::float8 AS weight
+            FROM chunks, websearch_to_tsquery('english', %s) query
+            WHERE tsv @@ query
+            ORDER BY ts_rank_cd(tsv, query) DESC
+            LIMIT %s
+        )
+        SELECT text_chunk, SUM(weight / (%s + rank)) AS score
+        FROM (
+            SELECT * FROM vector_hits
+            UNION ALL
+            SELECT * FROM keyword_hits
+        ) hits
+        GROUP BY text_chunk
+        ORDER BY score DESC
+        LIMIT %s;
+    """
+
+    print("[Retriever] Performing hybrid search (single round trip)...")
+    results = []
+    with _get_conn() as conn:
+        if conn is None: return ["Database connection error."]
+        try:
+            # (the pgvector adapter is registered once per pooled connection
+            # in _configure_conn)
+            with conn.cursor() as cur:
+                # binary=True moves the 768 floats as IEEE754 instead of a
+                # decimal text literal: ~3x fewer bytes on the wire and no
+                # string (de)serialization on either side
+                cur.execute(
+                    hybrid_query,
+                    (query_embedding, VECTOR_RRF_WEIGHT, query_embedding, TOP_K,
+                     KEYWORD_RRF_WEIGHT, query_text, TOP_K, RRF_K, FUSED_TOP_K),
+                    binary=True
+                )
+                results = [row[0] for row in cur.fetchall()]
+            print(f"[Retriever] Hybrid search found {len(results)} results.")
+        except (psycopg.Error, Exception) as e:
+            print(f"ERROR: [Retriever] Hybrid query failed: {e}", file=sys.stderr)
+            conn.rollback()
+
+    if not results:
+        return ["No relevant documents found."]
+
+    return results